@@ -0,0 +1,50 @@
+"""Report the size of postalcodes.db and how long common lookups take
+
+    python benchmark.py
+"""
+import os
+import random
+import timeit
+
+from postalcodes_ca import fsa_codes, postal_codes
+from postalcodes_ca.settings import db_location
+
+
+def report(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print(f"{label:<40} {seconds * 1000:>9.3f} ms")
+
+
+def main():
+    print(f"postalcodes.db: {os.path.getsize(db_location) / 1024 / 1024:.1f}MB")
+
+    random.seed(0)
+    codes = random.sample(list(postal_codes), 1000)
+    fsas = random.sample(list(fsa_codes), 100)
+
+    lookups = iter(codes * 100)
+    report("postal_codes.get()", lambda: postal_codes.get(next(lookups)), 1000)
+    lookups = iter(fsas * 100)
+    report("fsa_codes.get()", lambda: fsa_codes.get(next(lookups)), 100)
+    report("postal_codes.get_many(1000 codes)", lambda: postal_codes.get_many(codes), 5)
+    report(
+        "postal_codes.search(code='M5V%')",
+        lambda: postal_codes.search(code="M5V%"),
+        5,
+    )
+    report(
+        "postal_codes.search(name='Calgary')",
+        lambda: postal_codes.search(name="Calgary"),
+        5,
+    )
+    report("fsa_codes.search(code='T2%')", lambda: fsa_codes.search(code="T2%"), 20)
+    report(
+        "postal_codes.get_nearby('M5V 3L9', 2)",
+        lambda: postal_codes.get_nearby("M5V 3L9", 2),
+        5,
+    )
+    report("list(postal_codes)", lambda: list(postal_codes), 1)
+
+
+if __name__ == "__main__":
+    main()
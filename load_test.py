@@ -0,0 +1,107 @@
+"""Load test for `python -m postalcodes_ca serve`
+
+Start the server in one terminal
+
+    python -m postalcodes_ca serve
+
+then run this in another
+
+    python load_test.py --connections 64 --duration 10
+
+It opens keep-alive connections that each send lookups one after the other
+for random codes from the database and reports requests per second and
+latency percentiles.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import quote
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("server closed the connection")
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    body = await reader.readexactly(length)
+    return status, body
+
+
+async def request(reader, writer, host, target):
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    return await read_response(reader)
+
+
+async def worker(host, port, targets, deadline, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            target = random.choice(targets)
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, host, target)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+def percentile(sorted_values, percent):
+    return sorted_values[round(percent / 100 * (len(sorted_values) - 1))]
+
+
+async def main(args):
+    from postalcodes_ca import fsa_codes, postal_codes
+
+    db = fsa_codes if args.db == "fsa" else postal_codes
+    codes = random.sample(list(db), min(args.sample, len(db)))
+    targets = [f"/{args.db}/get?code={quote(code)}" for code in codes]
+
+    latencies = []
+    statuses = {}
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(
+        *(
+            worker(args.host, args.port, targets, deadline, latencies, statuses)
+            for _ in range(args.connections)
+        )
+    )
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, metrics = await request(reader, writer, args.host, "/metrics")
+    writer.close()
+    metrics = json.loads(metrics)
+
+    latencies.sort()
+    print(f"connections:        {args.connections}")
+    print(f"requests:           {len(latencies)}")
+    print(f"responses:          {statuses}")
+    print(f"requests/second:    {len(latencies) / elapsed:.0f}")
+    for p in (50, 90, 99):
+        print(f"p{p} latency:        {percentile(latencies, p) * 1000:.2f} ms")
+    print(f"average batch size: {metrics['average_batch_size']:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--db", choices=["fsa", "postal"], default="postal")
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument(
+        "--sample", type=int, default=10_000, help="number of distinct codes to use"
+    )
+    asyncio.run(main(parser.parse_args()))
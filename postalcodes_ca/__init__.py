@@ -1,7 +1,10 @@
 from dataclasses import dataclass
 import sqlite3
 import string
+import itertools
+import os
 import re
+import threading
 import time
 from collections import namedtuple
 from collections.abc import Mapping
@@ -9,6 +12,13 @@ from math import degrees, sin, asin, cos, radians
 
 from .settings import db_location
 
+# postal codes don't use D, F, I, O, Q or U
+POSTAL_CODE_ALPHABET = "ABCEGHJKLMNPRSTVWXYZ"
+# additionally, the first letter doesn't use W or Z
+POSTAL_CODE_FIRST_LETTER_ALPHABET = "ABCEGHJKLMNPRSTVXY"
+
+# TODO: check if using sets for the above improves performance
+
 
 def parse_fsa(fsa, strict=False):
     if not strict:
@@ -72,6 +82,66 @@ def parse_postal_code(pc, strict=False):
     return fsa + " " + ldu
 
 
+# There are 18*10*20 = 3,600 possible FSAs and 10*20*10 = 2,000 possible LDUs,
+# so a postal code fits in 23 bits. Both alphabets are sorted, so sorting the
+# integers gives the same order as sorting the strings.
+FSA_CHARACTERS = (
+    POSTAL_CODE_FIRST_LETTER_ALPHABET,
+    string.digits,
+    POSTAL_CODE_ALPHABET,
+)
+POSTAL_CODE_CHARACTERS = FSA_CHARACTERS + (
+    " ",
+    string.digits,
+    POSTAL_CODE_ALPHABET,
+    string.digits,
+)
+_FSAS = ["".join(fsa) for fsa in itertools.product(*FSA_CHARACTERS)]
+_LDUS = ["".join(ldu) for ldu in itertools.product(*POSTAL_CODE_CHARACTERS[4:])]
+_FSA_INTS = {fsa: i for i, fsa in enumerate(_FSAS)}
+_LDU_INTS = {ldu: i for i, ldu in enumerate(_LDUS)}
+
+
+def encode_fsa(fsa):
+    """Convert an FSA returned by parse_fsa() to an integer in range(3600)"""
+    try:
+        return _FSA_INTS[fsa]
+    except KeyError:
+        raise ValueError(f"invalid FSA: {str(fsa)!r}") from None
+
+
+def decode_fsa(code):
+    """Convert an integer returned by encode_fsa() back to an FSA"""
+    # bool is a subclass of int
+    if type(code) is not int:
+        raise TypeError(f'expected int, got "{type(code)}"')
+    if not 0 <= code < len(_FSAS):
+        raise ValueError(f"invalid encoded FSA: {code!r}")
+    return _FSAS[code]
+
+
+def encode_postal_code(pc):
+    """Convert a postal code returned by parse_postal_code() to an integer in
+    range(7_200_000)"""
+    if len(pc) != 7 or pc[3] != " ":
+        raise ValueError(f"invalid postal code: {str(pc)!r}")
+    try:
+        return _FSA_INTS[pc[:3]] * len(_LDUS) + _LDU_INTS[pc[4:]]
+    except KeyError:
+        raise ValueError(f"invalid postal code: {str(pc)!r}") from None
+
+
+def decode_postal_code(code):
+    """Convert an integer returned by encode_postal_code() back to a postal code"""
+    # bool is a subclass of int
+    if type(code) is not int:
+        raise TypeError(f'expected int, got "{type(code)}"')
+    if not 0 <= code < len(_FSAS) * len(_LDUS):
+        raise ValueError(f"invalid encoded postal code: {code!r}")
+    fsa, ldu = divmod(code, len(_LDUS))
+    return _FSAS[fsa] + " " + _LDUS[ldu]
+
+
 @dataclass
 class Code:
     """A base class used for postal codes and FSA codes"""
@@ -132,9 +202,17 @@ class ConnectionManager:
         # test out the connection...
         conn = sqlite3.connect(db_location)
         conn.close()
+        # Opening a connection and parsing the schema takes longer than
+        # looking up a code, so each thread reuses its own connection.
+        # SQLite connections must not be used across fork(), so a forked
+        # process opens new ones instead of using the parent's.
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
 
-    def query(self, sql, args=()):
-        conn = None
         # If there is trouble reading the file, try 10 times then just give up...
         for retry_count in range(10):
             try:
@@ -147,27 +225,66 @@ class ConnectionManager:
                 "Can't connect to sqlite database at " + str(db_location)
             )
 
-        cursor = conn.cursor()
+        # used to match LIKE patterns against the integer-encoded codes
+        conn.create_function("decode_fsa", 1, decode_fsa)
+        conn.create_function("decode_postal_code", 1, decode_postal_code)
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def query(self, sql, args=()):
+        cursor = self._connect().cursor()
         cursor.execute(sql, args)
         res = cursor.fetchall()
-        conn.close()
+        cursor.close()
         return res
 
-
-QUERY = "SELECT * FROM {table_name} WHERE code=?"
-RANGE_QUERY = "SELECT * FROM {table_name} WHERE longitude >= ? and longitude <= ? AND latitude >= ? and latitude <= ?"
-FIND_QUERY = (
-    "SELECT * FROM {table_name} WHERE code LIKE ? AND name LIKE ? AND province LIKE ?"
+    def iter_query(self, sql, args=()):
+        """Like query() but yields rows as they're read from the database"""
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+
+# Codes are stored as integers (see encode_postal_code()) and names and
+# provinces are stored once each in their own tables, see import.py
+SELECT = (
+    "SELECT code, name, province, latitude, longitude{extra_columns} "
+    "FROM {table_name} "
+    "JOIN Names ON Names.id = name_id "
+    "JOIN Provinces ON Provinces.id = province_id"
 )
+QUERY = SELECT + " WHERE code=?"
+# the "(?, ?, ...)" placeholders are appended by get_many()
+MANY_QUERY = SELECT + " WHERE code IN "
+RANGE_QUERY = (
+    SELECT
+    + " WHERE longitude >= ? and longitude <= ? AND latitude >= ? and latitude <= ?"
+)
+# search() only adds the conditions for the arguments it's given
+FIND_QUERY = SELECT
+CODE_RANGE_CONDITION = "code >= ? AND code < ?"
+# for patterns with wildcards other than a trailing %, this calls into Python
+# for every row in the CODE_RANGE_CONDITION range
+CODE_LIKE_CONDITION = "{decode_function}(code) LIKE ?"
+NAME_CONDITION = "name_id IN (SELECT id FROM Names WHERE name LIKE ?)"
+PROVINCE_CONDITION = "province_id IN (SELECT id FROM Provinces WHERE province LIKE ?)"
 ALL_QUERY = "SELECT code FROM {table_name}"
 LEN_QUERY = "SELECT COUNT(*) FROM {table_name}"
 
-# postal codes don't use D, F, I, O, Q or U
-POSTAL_CODE_ALPHABET = "ABCEGHJKLMNPRSTVWXYZ"
-# additionally, the first letter doesn't use W or Z
-POSTAL_CODE_FIRST_LETTER_ALPHABET = "ABCEGHJKLMNPRSTVXY"
+# the number of rows read at a time by ConnectionManager.iter_query()
+STREAM_BATCH_SIZE = 1000
 
-# TODO: check if using sets for the above improves performance
+# SQLite versions before 3.32 only allow 999 "?" parameters per query
+MAX_QUERY_PARAMETERS = 500
 
 
 class CodeNotFoundException(Exception):
@@ -186,6 +303,10 @@ class CodeDatabase(Mapping):
     _type = Code
     _not_found_exception = CodeNotFoundException
     _parse = lambda x: x
+    _encode = staticmethod(lambda x: x)
+    _decode = staticmethod(lambda x: x)
+    # the characters allowed at each position of a code
+    _characters = ()
 
     def __init__(self, conn_manager=None):
         if conn_manager is None:
@@ -194,7 +315,7 @@ class CodeDatabase(Mapping):
 
     def _format_result(self, codes):
         if codes:
-            return [self._type(*code) for code in codes]
+            return [self._type(self._decode(code), *rest) for code, *rest in codes]
         return None
 
     def get_nearby(self, code, radius):
@@ -230,36 +351,82 @@ class CodeDatabase(Mapping):
             )
         )
 
-    def search(self, code=None, name=None, province=None):
+    def _code_range(self, pattern):
+        """Return the (start, stop) range of encoded codes that start with the
+        literal prefix of the LIKE pattern, and whether every code in that range
+        matches the pattern"""
+        prefix = re.split("[%_]", pattern, maxsplit=1)[0]
+        wildcards = pattern[len(prefix) :]
+
+        if len(prefix) > len(self._characters):
+            return 0, 0, True
+        # without a wildcard the pattern has to match the whole code
+        if not wildcards and len(prefix) < len(self._characters):
+            return 0, 0, True
+        for char, allowed in zip(prefix, self._characters):
+            if char not in allowed:
+                return 0, 0, True
+
+        # the alphabets are sorted, and so are the encoded codes
+        rest = self._characters[len(prefix) :]
+        first = prefix + "".join(allowed[0] for allowed in rest)
+        last = prefix + "".join(allowed[-1] for allowed in rest)
+        exact = not wildcards.strip("%")
+        return self._encode(first), self._encode(last) + 1, exact
+
+    def search_iter(self, code=None, name=None, province=None, limit=None, offset=None):
+        """Like search() but yields results one at a time, in order of their code.
+
+        The generator has to be consumed in the thread that created it.
+        """
         # TODO: allow passing an FSA/PostalCode object?
-        if code is None:
-            code = "%"
-        else:
+        conditions = []
+        args = []
+        if code is not None:
             # TODO: validate?
             code = code.upper()
-
-        if name is None:
-            name = "%"
-        else:
-            name = name.upper()
-
-        if province is None:
-            province = "%"
-        else:
-            province = province.upper()
-
+            start, stop, exact = self._code_range(code)
+            conditions.append(CODE_RANGE_CONDITION)
+            args.extend((start, stop))
+            if not exact:
+                conditions.append(self.CODE_LIKE_CONDITION)
+                args.append(code)
+        if name is not None:
+            conditions.append(NAME_CONDITION)
+            args.append(name.upper())
+        if province is not None:
+            conditions.append(PROVINCE_CONDITION)
+            args.append(province.upper())
+
+        sql = self.FIND_QUERY
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY code"
+        if limit is not None or offset is not None:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend((-1 if limit is None else limit, offset or 0))
+
+        for code, *rest in self.conn_manager.iter_query(sql, args):
+            yield self._type(self._decode(code), *rest)
+
+    def search(self, code=None, name=None, province=None, limit=None, offset=None):
         # TODO: return empty list instead of None?
-        return self._format_result(
-            self.conn_manager.query(self.FIND_QUERY, (code, name, province))
-        )
+        return list(self.search_iter(code, name, province, limit, offset)) or None
 
-    def get(self, code, default=None, strict=True):
+    def parse(self, code, strict=True):
+        """Return the code as it's looked up by get(), raising TypeError or
+        ValueError if it isn't a valid code"""
         if isinstance(code, self._type):
             code = code.code
         if not isinstance(code, str):
             raise TypeError(f'expected string or {self._type}, got "{type(code)}"')
-        code = self._parse(code, strict)
-        results = self._format_result(self.conn_manager.query(self.QUERY, (code,)))
+        return self._parse(code, strict)
+
+    def get(self, code, default=None, strict=True):
+        code = self.parse(code, strict)
+        results = self._format_result(
+            self.conn_manager.query(self.QUERY, (self._encode(code),))
+        )
         if results is None:
             return default
         if len(results) > 1:
@@ -267,6 +434,28 @@ class CodeDatabase(Mapping):
             raise ValueError(f"looking up {code!r} returned {len(results)} results")
         return results[0]
 
+    def get_many(self, codes, default=None, strict=True):
+        """Look up several codes at once, using one query per 500 codes.
+
+        Returns a list in the same order as `codes`, with `default` in place
+        of any code that isn't in the database.
+        """
+        parsed = [self.parse(code, strict) for code in codes]
+
+        found = {}
+        unique = list(dict.fromkeys(parsed))
+        for start in range(0, len(unique), MAX_QUERY_PARAMETERS):
+            chunk = [
+                self._encode(code)
+                for code in unique[start : start + MAX_QUERY_PARAMETERS]
+            ]
+            sql = self.MANY_QUERY + "(" + ", ".join("?" * len(chunk)) + ")"
+            rows = self.conn_manager.query(sql, chunk)
+            for result in self._format_result(rows) or []:
+                # the data has no duplicates, see test_data()
+                found.setdefault(result.code, result)
+        return [found.get(code, default) for code in parsed]
+
     def __getitem__(self, code):
         res = self.get(code)
         if res is None:
@@ -274,8 +463,8 @@ class CodeDatabase(Mapping):
         return res
 
     def __iter__(self):
-        for res in self.conn_manager.query(self.ALL_QUERY):
-            yield res[0]
+        for res in self.conn_manager.iter_query(self.ALL_QUERY):
+            yield self._decode(res[0])
 
     def __len__(self):
         return self.conn_manager.query(self.LEN_QUERY)[0][0]
@@ -288,9 +477,15 @@ class FSADatabase(CodeDatabase):
     def _parse(self, *args, **kwargs):
         return parse_fsa(*args, **kwargs)
 
-    QUERY = QUERY.format(table_name="FSACodes")
-    RANGE_QUERY = RANGE_QUERY.format(table_name="FSACodes")
-    FIND_QUERY = FIND_QUERY.format(table_name="FSACodes")
+    _encode = staticmethod(encode_fsa)
+    _decode = staticmethod(decode_fsa)
+    _characters = FSA_CHARACTERS
+
+    QUERY = QUERY.format(table_name="FSACodes", extra_columns=", accuracy")
+    MANY_QUERY = MANY_QUERY.format(table_name="FSACodes", extra_columns=", accuracy")
+    RANGE_QUERY = RANGE_QUERY.format(table_name="FSACodes", extra_columns=", accuracy")
+    FIND_QUERY = FIND_QUERY.format(table_name="FSACodes", extra_columns=", accuracy")
+    CODE_LIKE_CONDITION = CODE_LIKE_CONDITION.format(decode_function="decode_fsa")
     ALL_QUERY = ALL_QUERY.format(table_name="FSACodes")
     LEN_QUERY = LEN_QUERY.format(table_name="FSACodes")
 
@@ -302,9 +497,17 @@ class PostalCodeDatabase(CodeDatabase):
     def _parse(self, *args, **kwargs):
         return parse_postal_code(*args, **kwargs)
 
-    QUERY = QUERY.format(table_name="PostalCodes")
-    RANGE_QUERY = RANGE_QUERY.format(table_name="PostalCodes")
-    FIND_QUERY = FIND_QUERY.format(table_name="PostalCodes")
+    _encode = staticmethod(encode_postal_code)
+    _decode = staticmethod(decode_postal_code)
+    _characters = POSTAL_CODE_CHARACTERS
+
+    QUERY = QUERY.format(table_name="PostalCodes", extra_columns="")
+    MANY_QUERY = MANY_QUERY.format(table_name="PostalCodes", extra_columns="")
+    RANGE_QUERY = RANGE_QUERY.format(table_name="PostalCodes", extra_columns="")
+    FIND_QUERY = FIND_QUERY.format(table_name="PostalCodes", extra_columns="")
+    CODE_LIKE_CONDITION = CODE_LIKE_CONDITION.format(
+        decode_function="decode_postal_code"
+    )
     ALL_QUERY = ALL_QUERY.format(table_name="PostalCodes")
     LEN_QUERY = LEN_QUERY.format(table_name="PostalCodes")
 
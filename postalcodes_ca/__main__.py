@@ -0,0 +1,56 @@
+import argparse
+
+from .server import serve
+from .server import DEFAULT_BATCH_DELAY, DEFAULT_BATCH_SIZE, DEFAULT_KEEP_ALIVE_TIMEOUT
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m postalcodes_ca")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="run an HTTP/JSON server for looking up codes"
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument(
+        "--batch-delay",
+        type=float,
+        default=DEFAULT_BATCH_DELAY * 1000,
+        help="milliseconds to wait for more lookups before querying the database "
+        "(default: %(default)s)",
+    )
+    serve_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="maximum number of codes looked up in one query (default: %(default)s)",
+    )
+    serve_parser.add_argument(
+        "--keep-alive-timeout",
+        type=float,
+        default=DEFAULT_KEEP_ALIVE_TIMEOUT,
+        help="seconds to keep idle connections open (default: %(default)s)",
+    )
+    serve_parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="number of threads used for database queries",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        serve(
+            args.host,
+            args.port,
+            batch_delay=args.batch_delay / 1000,
+            batch_size=args.batch_size,
+            keep_alive_timeout=args.keep_alive_timeout,
+            threads=args.threads,
+        )
+
+
+if __name__ == "__main__":
+    main()
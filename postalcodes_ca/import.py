@@ -3,10 +3,12 @@ import os
 import csv
 import sys
 
-try:
-    from settings import db_location
-except:
-    from postalcodes_ca.settings import db_location
+# this file is run as a script, so postalcodes_ca isn't importable by default
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postalcodes_ca import encode_fsa, encode_postal_code  # noqa: E402
+from postalcodes_ca import parse_fsa, parse_postal_code  # noqa: E402
+from postalcodes_ca.settings import db_location  # noqa: E402
 
 FSA_FILE = "CA.tsv"
 POSTAL_CODES_FILE = "CA_full.txt"
@@ -76,6 +78,14 @@ def read_codes(filename):
                 log_error(f"code is too short {code!r}", row, idx)
                 continue
 
+            # codes that don't parse can't be encoded to be stored
+            parse = parse_fsa if filename == FSA_FILE else parse_postal_code
+            try:
+                parse(code, strict=True)
+            except ValueError as e:
+                log_error(str(e), row, idx)
+                continue
+
             for var, val in [
                 ("code", code),
                 ("name", name),
@@ -135,51 +145,99 @@ def read_codes(filename):
     return codes.values()
 
 
+def intern(values, value):
+    """Return the id of value in values, adding it if it's new"""
+    return values.setdefault(value, len(values) + 1)
+
+
 os.remove(db_location)
 conn = sqlite3.connect(db_location)
 c = conn.cursor()
+
+# Codes are stored as integers (see encode_postal_code()) in WITHOUT ROWID
+# tables, so the code is the primary key and doesn't need a separate index.
+# Names and provinces are repeated hundreds of thousands of times, so they're
+# stored once in their own tables and the codes tables refer to them by id.
+names = {}
+provinces = {}
+
 c.execute("DROP TABLE IF EXISTS FSACodes;")
 c.execute(
     """\
 CREATE TABLE FSACodes(
-    code VARCHAR(3) NOT NULL,
-    name VARCHAR(180) NOT NULL,
-    province VARCHAR(100) NOT NULL,
+    code INTEGER PRIMARY KEY,
+    name_id INTEGER NOT NULL,
+    province_id INTEGER NOT NULL,
     -- province_code VARCHAR(2) NOT NULL,
     latitude DOUBLE NOT NULL,
     longitude DOUBLE NOT NULL,
     accuracy INT
-);"""
+) WITHOUT ROWID;"""
 )
-c.execute("CREATE INDEX fsa_code_index ON FSACodes(code);")
-c.execute("CREATE INDEX fsa_name_index ON FSACodes(name);")
-c.execute("CREATE INDEX fsa_province_index ON FSACodes(province);")
-
-for row in read_codes(FSA_FILE):
-    c.execute("INSERT INTO FSACodes values(?,?,?,?,?,?)", row)
+c.execute("CREATE INDEX fsa_name_index ON FSACodes(name_id);")
+
+for code, name, province, lat, longt, accuracy in read_codes(FSA_FILE):
+    c.execute(
+        "INSERT INTO FSACodes values(?,?,?,?,?,?)",
+        (
+            encode_fsa(code),
+            intern(names, name),
+            intern(provinces, province),
+            lat,
+            longt,
+            accuracy,
+        ),
+    )
 
 c.execute("DROP TABLE IF EXISTS PostalCodes;")
 c.execute(
     """\
 CREATE TABLE PostalCodes(
-    code VARCHAR(7) NOT NULL,
-    name VARCHAR(180) NOT NULL,
-    province VARCHAR(100) NOT NULL,
+    code INTEGER PRIMARY KEY,
+    name_id INTEGER NOT NULL,
+    province_id INTEGER NOT NULL,
     latitude DOUBLE NOT NULL,
     longitude DOUBLE NOT NULL
-);"""
+) WITHOUT ROWID;"""
 )
-# These indeces double the file size of postalcodes.db
-c.execute("CREATE INDEX postal_code_index ON PostalCodes(code);")
-c.execute("CREATE INDEX postal_name_index ON PostalCodes(name);")
-c.execute("CREATE INDEX postal_province_index ON PostalCodes(province);")
+# There are only 13 provinces, so an index on province_id wouldn't narrow
+# down searches by much and would add a few MB to postalcodes.db
+c.execute("CREATE INDEX postal_name_index ON PostalCodes(name_id);")
 
 postal_codes = read_codes(POSTAL_CODES_FILE)
 # Santa's postal code is missing from the postal codes but not from the FSA codes
 SANTA = ("H0H 0H0", "Reserved (Santa Claus)", "Quebec", 90, 0, 6)
-for postal_code in list(postal_codes) + [SANTA]:
+for code, name, province, lat, longt, _ in list(postal_codes) + [SANTA]:
     # don't include accuracy, it's always 6
-    c.execute("INSERT INTO PostalCodes values(?,?,?,?,?)", postal_code[:-1])
+    c.execute(
+        "INSERT INTO PostalCodes values(?,?,?,?,?)",
+        (
+            encode_postal_code(code),
+            intern(names, name),
+            intern(provinces, province),
+            lat,
+            longt,
+        ),
+    )
+
+c.execute("DROP TABLE IF EXISTS Names;")
+c.execute("CREATE TABLE Names(id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);")
+c.executemany("INSERT INTO Names values(?,?)", ((i, n) for n, i in names.items()))
+
+c.execute("DROP TABLE IF EXISTS Provinces;")
+c.execute(
+    "CREATE TABLE Provinces(id INTEGER PRIMARY KEY, province TEXT NOT NULL UNIQUE);"
+)
+c.executemany(
+    "INSERT INTO Provinces values(?,?)", ((i, p) for p, i in provinces.items())
+)
 
 conn.commit()
+c.execute("VACUUM;")
 c.close()
+
+print(
+    f"wrote {len(names)} names, {len(provinces)} provinces and "
+    f"{os.path.getsize(db_location) / 1024 / 1024:.1f}MB to {db_location}",
+    file=sys.stderr,
+)
@@ -0,0 +1,413 @@
+"""A small HTTP/JSON server for looking up codes from other languages
+
+Start it with
+
+    python -m postalcodes_ca serve --port 8000
+
+and query it with
+
+    GET /fsa/get?code=T2S
+    GET /postal/get?code=M5V%203L9
+    GET /postal/get_many?code=M5V%203L9&code=T2S%201J4
+    POST /postal/get_many  (with a JSON list of codes as the body)
+    GET /fsa/get_nearby?code=T2S&radius=5
+    GET /fsa/search?name=Calgary%25&province=Alberta
+    GET /postal/search?code=M%25&limit=100&offset=200
+    GET /metrics
+
+Lookups that arrive within a few milliseconds of each other are answered by
+a single `get_many()` query, and identical `get_nearby()`/`search()` requests
+that are running at the same time share one query.
+"""
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import CodeNotFoundException, FSADatabase, PostalCodeDatabase
+
+DEFAULT_BATCH_DELAY = 0.002  # seconds
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_KEEP_ALIVE_TIMEOUT = 5  # seconds
+# enough for a get_many() request with tens of thousands of codes
+MAX_BODY_SIZE = 1024 * 1024  # bytes
+# the largest limit or offset SQLite accepts
+MAX_SQLITE_INTEGER = 2**63 - 1
+# the number of most recent requests used for the latency percentiles
+LATENCY_SAMPLES = 10_000
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _format_code(code):
+    if code is None:
+        return None
+    return asdict(code)
+
+
+def _parse_bool(value):
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise HTTPError(HTTPStatus.BAD_REQUEST, f"expected a boolean, got {value!r}")
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    idx = round(percent / 100 * (len(sorted_values) - 1))
+    return sorted_values[idx]
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.requests = Counter()
+        self.responses = Counter()
+        self.connections = 0
+        self.open_connections = 0
+        self.lookups = 0
+        self.batches = 0
+        self.shared_queries = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        return {
+            "uptime": time.time() - self.started,
+            "requests": sum(self.requests.values()),
+            "requests_by_endpoint": dict(self.requests),
+            "responses_by_status": {str(k): v for k, v in self.responses.items()},
+            "connections": self.connections,
+            "open_connections": self.open_connections,
+            "lookups": self.lookups,
+            "batches": self.batches,
+            "average_batch_size": self.lookups / self.batches if self.batches else None,
+            "shared_queries": self.shared_queries,
+            "latency_ms": {
+                "p50": _percentile(latencies, 50),
+                "p90": _percentile(latencies, 90),
+                "p99": _percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+
+class Batcher:
+    """Collects concurrent lookups and answers them with one get_many() call"""
+
+    def __init__(self, db, executor, metrics, delay, max_size):
+        self.db = db
+        self.executor = executor
+        self.metrics = metrics
+        self.delay = delay
+        self.max_size = max_size
+        self._pending = {}
+        self._flush_handle = None
+
+    async def get(self, code, strict=True):
+        # Validate before queueing so one bad code doesn't fail the whole batch
+        code = self.db.parse(code, strict)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(code, []).append(future)
+        self.metrics.lookups += 1
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            self.metrics.batches += 1
+            asyncio.ensure_future(self._run(pending))
+
+    async def _run(self, pending):
+        loop = asyncio.get_running_loop()
+        codes = list(pending)
+        try:
+            results = await loop.run_in_executor(self.executor, self.db.get_many, codes)
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for code, result in zip(codes, results):
+            for future in pending[code]:
+                if not future.done():
+                    future.set_result(result)
+
+
+class Server:
+    def __init__(
+        self,
+        batch_delay=DEFAULT_BATCH_DELAY,
+        batch_size=DEFAULT_BATCH_SIZE,
+        keep_alive_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT,
+        threads=None,
+        databases=None,
+    ):
+        if databases is None:
+            databases = {"fsa": FSADatabase(), "postal": PostalCodeDatabase()}
+        self.databases = databases
+        self.keep_alive_timeout = keep_alive_timeout
+        self.metrics = Metrics()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.batchers = {
+            name: Batcher(db, self.executor, self.metrics, batch_delay, batch_size)
+            for name, db in databases.items()
+        }
+        self.endpoints = {
+            "get": (self._get, ("GET",)),
+            "get_many": (self._get_many, ("GET", "POST")),
+            "get_nearby": (self._get_nearby, ("GET",)),
+            "search": (self._search, ("GET",)),
+        }
+        self._in_flight = {}
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host="127.0.0.1", port=8000):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def _shared(self, key, func, *args):
+        """Run func(*args) in a thread, reusing the result of an identical
+        call that is already running"""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.metrics.shared_queries += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, func, *args)
+        self._in_flight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    async def _handle(self, reader, writer):
+        self.metrics.connections += 1
+        self.metrics.open_connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request(reader), self.keep_alive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                except HTTPError as e:
+                    await self._respond(writer, e.status, {"error": str(e)}, False)
+                    break
+                if request is None:
+                    break
+                method, target, keep_alive, body = request
+
+                start = time.perf_counter()
+                status, payload = await self._dispatch(method, target, body)
+                self.metrics.latencies.append((time.perf_counter() - start) * 1000)
+                self.metrics.responses[int(status)] += 1
+                await self._respond(writer, status, payload, keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.metrics.open_connections -= 1
+            writer.close()
+
+    async def _read_request(self, reader):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return None
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "too large")
+
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "malformed request line")
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        body = b""
+        if "content-length" in headers:
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "invalid Content-Length")
+            if length < 0:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "invalid Content-Length")
+            if length > MAX_BODY_SIZE:
+                raise HTTPError(
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                    f"request body is larger than {MAX_BODY_SIZE} bytes",
+                )
+            body = await reader.readexactly(length)
+        return method, target, keep_alive, body
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        status = HTTPStatus(status)
+        body = json.dumps(payload).encode()
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _dispatch(self, method, target, body):
+        url = urlsplit(target)
+        params = parse_qs(url.query, keep_blank_values=True)
+        path = [unquote(part) for part in url.path.strip("/").split("/")]
+        if path == ["metrics"]:
+            self.metrics.requests["metrics"] += 1
+            return HTTPStatus.OK, self.metrics.as_dict()
+        if len(path) != 2 or path[0] not in self.databases:
+            self.metrics.requests["unknown"] += 1
+            return HTTPStatus.NOT_FOUND, {"error": f"unknown endpoint {url.path!r}"}
+        db_name, action = path
+        if action not in self.endpoints:
+            self.metrics.requests["unknown"] += 1
+            return HTTPStatus.NOT_FOUND, {"error": f"unknown endpoint {url.path!r}"}
+        self.metrics.requests[db_name + "/" + action] += 1
+
+        handler, methods = self.endpoints[action]
+        if method not in methods:
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": f"{method} not allowed"}
+        try:
+            return HTTPStatus.OK, await handler(db_name, params, body)
+        except HTTPError as e:
+            return e.status, {"error": str(e)}
+        except CodeNotFoundException as e:
+            return HTTPStatus.NOT_FOUND, {"error": str(e)}
+        except (ValueError, TypeError) as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(e)}
+
+    @staticmethod
+    def _param(params, name, required=False):
+        values = params.get(name)
+        if not values:
+            if required:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, f"missing {name!r} parameter")
+            return None
+        return values[-1]
+
+    def _int_param(self, params, name):
+        value = self._param(params, name)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            value = None
+        if value is None or not 0 <= value <= MAX_SQLITE_INTEGER:
+            raise HTTPError(
+                HTTPStatus.BAD_REQUEST,
+                f"{name!r} must be an integer between 0 and {MAX_SQLITE_INTEGER}",
+            )
+        return value
+
+    def _strict(self, params):
+        strict = self._param(params, "strict")
+        return True if strict is None else _parse_bool(strict)
+
+    async def _get(self, db_name, params, body):
+        code = self._param(params, "code", required=True)
+        result = await self.batchers[db_name].get(code, self._strict(params))
+        if result is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"could not find code {code!r}")
+        return _format_code(result)
+
+    async def _get_many(self, db_name, params, body):
+        if body:
+            try:
+                codes = json.loads(body)
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "body must be a JSON list")
+            if not isinstance(codes, list):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "body must be a JSON list")
+        else:
+            codes = params.get("code", [])
+        strict = self._strict(params)
+        batcher = self.batchers[db_name]
+        results = await asyncio.gather(*(batcher.get(c, strict) for c in codes))
+        return [_format_code(result) for result in results]
+
+    async def _get_nearby(self, db_name, params, body):
+        code = self._param(params, "code", required=True)
+        radius = float(self._param(params, "radius", required=True))
+        db = self.databases[db_name]
+        key = ("get_nearby", db_name, code, radius)
+        results = await self._shared(key, db.get_nearby, code, radius)
+        return [_format_code(result) for result in results or []]
+
+    async def _search(self, db_name, params, body):
+        code = self._param(params, "code")
+        name = self._param(params, "name")
+        province = self._param(params, "province")
+        limit = self._int_param(params, "limit")
+        offset = self._int_param(params, "offset")
+        db = self.databases[db_name]
+        args = (code, name, province, limit, offset)
+        results = await self._shared(("search", db_name) + args, db.search, *args)
+        return [_format_code(result) for result in results or []]
+
+
+def serve(host="127.0.0.1", port=8000, **kwargs):
+    """Run a Server until interrupted"""
+
+    async def run():
+        server = Server(**kwargs)
+        async_server = await server.start(host, port)
+        print(f"Serving on http://{host}:{server.port}")
+        async with async_server:
+            await async_server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
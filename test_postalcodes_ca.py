@@ -1,5 +1,12 @@
+import asyncio
+import http.client
 import itertools
+import json
+import os
+import urllib.request
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
 from string import digits, ascii_uppercase
 
 import pytest
@@ -7,7 +14,10 @@ import pytest
 from postalcodes_ca import postal_codes, fsa_codes
 from postalcodes_ca import PostalCode, FSA
 from postalcodes_ca import parse_postal_code, parse_fsa
+from postalcodes_ca import encode_postal_code, decode_postal_code
+from postalcodes_ca import encode_fsa, decode_fsa
 from postalcodes_ca import POSTAL_CODE_ALPHABET, POSTAL_CODE_FIRST_LETTER_ALPHABET
+from postalcodes_ca.server import Server
 
 
 def test_get():
@@ -194,3 +204,212 @@ def test_len_and_iter():
 
     assert len(fsa_codes) > 1600
     assert len(list(fsa_codes)) == len(fsa_codes)
+
+
+def test_get_many():
+    res = postal_codes.get_many(["M5V 3L9", "A9X 6T9", "M5V 3L9"])
+    assert res == [postal_codes["M5V 3L9"], None, postal_codes["M5V 3L9"]]
+    res = fsa_codes.get_many(["t2s", fsa_codes["V5K"]], default=False, strict=False)
+    assert res == [fsa_codes["T2S"], fsa_codes["V5K"]]
+    assert fsa_codes.get_many([]) == []
+    with pytest.raises(ValueError):
+        fsa_codes.get_many(["T2S", "T2O"])
+
+
+def test_server():
+    def make_requests(port):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+
+        def request(method, target, body=None):
+            conn.request(method, target, body=body)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+
+        status, res = request("GET", "/postal/get?code=M5V%203L9")
+        assert status == 200
+        assert PostalCode(**res) == postal_codes["M5V 3L9"]
+        assert request("GET", "/postal/get?code=A9X%206T9")[0] == 404
+        assert request("GET", "/fsa/get?code=T2O")[0] == 400
+        assert request("GET", "/fsa/get?code=t2s&strict=false")[1]["code"] == "T2S"
+
+        status, res = request("GET", "/fsa/get_many?code=T2S&code=A9X")
+        assert res == [asdict(fsa_codes["T2S"]), None]
+        status, res = request("POST", "/fsa/get_many", json.dumps(["V5K"]))
+        assert res == [asdict(fsa_codes["V5K"])]
+        for strict in ["true", "false"]:
+            status, res = request(
+                "POST", f"/fsa/get_many?strict={strict}", json.dumps([123])
+            )
+            assert status == 400
+            assert "expected string" in res["error"]
+
+        status, res = request("GET", "/fsa/get_nearby?code=T2S&radius=5")
+        assert len(res) == len(fsa_codes.get_nearby("T2S", 5))
+        status, res = request("GET", "/fsa/search?code=T2%25&name=Calgary%25")
+        assert len(res) == len(fsa_codes.search(code="T2%", name="Calgary%"))
+        status, res = request("GET", "/postal/search?code=M%25&limit=3&offset=1")
+        assert res == [asdict(r) for r in postal_codes.search(code="M%", limit=4)[1:]]
+        for limit in ["99999999999999999999999", "-1", "ten"]:
+            assert request("GET", f"/fsa/search?code=T%25&limit={limit}")[0] == 400
+            assert request("GET", f"/fsa/search?code=T%25&offset={limit}")[0] == 400
+
+        assert request("GET", "/fsa/nonsense")[0] == 404
+
+        for length, status in [(-1, 400), (10 * 1024 * 1024, 413)]:
+            bad_conn = http.client.HTTPConnection("127.0.0.1", port)
+            bad_conn.putrequest("POST", "/fsa/get_many")
+            bad_conn.putheader("Content-Length", str(length))
+            bad_conn.endheaders()
+            assert bad_conn.getresponse().status == status
+            bad_conn.close()
+        assert request("GET", "/metrics")[1]["connections"] == 3
+
+        # concurrent lookups are answered by shared queries
+        before = request("GET", "/metrics")[1]
+        codes = list(itertools.islice(fsa_codes, 200))
+        with ThreadPoolExecutor(20) as executor:
+            responses = executor.map(
+                lambda code: urllib.request.urlopen(
+                    f"http://127.0.0.1:{port}/fsa/get?code={code}"
+                ).read(),
+                codes,
+            )
+            assert [json.loads(r)["code"] for r in responses] == codes
+        after = request("GET", "/metrics")[1]
+        return before, after
+
+    async def run():
+        server = Server(batch_delay=0.01)
+        await server.start("127.0.0.1", 0)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, make_requests, server.port)
+        finally:
+            await server.close()
+
+    before, after = asyncio.run(run())
+    assert after["lookups"] - before["lookups"] == 200
+    assert after["batches"] - before["batches"] < 200
+
+
+def test_encode_decode():
+    fsas = [
+        "".join(fsa)
+        for fsa in itertools.product(
+            POSTAL_CODE_FIRST_LETTER_ALPHABET, digits, POSTAL_CODE_ALPHABET
+        )
+    ]
+    assert [encode_fsa(fsa) for fsa in fsas] == list(range(3600))
+    assert [decode_fsa(i) for i in range(3600)] == fsas
+
+    assert encode_postal_code("A0A 0A0") == 0
+    assert encode_postal_code("Y9Z 9Z9") == 7_199_999
+    for code in ["M5V 3L9", "H0H 0H0", "T2S 1J4", "A0A 0A1", "Y9Z 9Z9"]:
+        assert decode_postal_code(encode_postal_code(code)) == code
+    # the integers sort the same way as the strings
+    codes = ["A0A 0A0", "A0A 0A1", "A0A 0B0", "A0A 1A0", "M5V 3L9", "M5W 0A0"]
+    assert sorted(codes, key=encode_postal_code) == sorted(codes)
+    assert [encode_postal_code(c) for c in codes] == sorted(
+        encode_postal_code(c) for c in codes
+    )
+
+    for invalid in ["T2O", "t2s", "T2S ", ""]:
+        with pytest.raises(ValueError):
+            encode_fsa(invalid)
+    for invalid in ["M5V3L9", "M5V 3L", "m5v 3l9", "Z5V 3L9", "M5V13L9", "M5VX3L9"]:
+        with pytest.raises(ValueError):
+            encode_postal_code(invalid)
+    for invalid in [-1, 3600]:
+        with pytest.raises(ValueError):
+            decode_fsa(invalid)
+    for invalid in [-1, 7_200_000]:
+        with pytest.raises(ValueError):
+            decode_postal_code(invalid)
+    for invalid in [True, 1.5, "1"]:
+        with pytest.raises(TypeError):
+            decode_fsa(invalid)
+        with pytest.raises(TypeError):
+            decode_postal_code(invalid)
+
+
+def test_search_code_ranges():
+    # prefixes are looked up as ranges of encoded codes, compare them against
+    # a pattern that has to be matched with LIKE
+    for db, prefix in [
+        (fsa_codes, "T"),
+        (fsa_codes, "T2"),
+        (fsa_codes, "T2S"),
+        (postal_codes, "M5V"),
+        (postal_codes, "M5V 3L"),
+    ]:
+        res = db.search(code=prefix + "%")
+        like_res = db.search(code=prefix[:-1] + "_%")
+        assert res == [r for r in like_res if r.code.startswith(prefix)]
+        assert all(r.code.startswith(prefix) for r in res)
+        assert [r.code for r in res] == sorted(r.code for r in res)
+
+    assert postal_codes.search(code="m5v 3l9") == [postal_codes["M5V 3L9"]]
+    assert fsa_codes.search(code="T2S") == [fsa_codes["T2S"]]
+    assert fsa_codes.search(code="T2") is None
+    assert fsa_codes.search(code="T2S%%") == [fsa_codes["T2S"]]
+    assert postal_codes.search(code="M5V3%") is None
+    assert postal_codes.search(code="M5V 3L9%") == [postal_codes["M5V 3L9"]]
+    assert postal_codes.search(code="M5V 3L9 %") is None
+    assert fsa_codes.search(code="Z%") is None
+    assert fsa_codes.search(code="") is None
+    assert len(fsa_codes.search(code="%")) == len(fsa_codes)
+
+
+def test_search_code_wildcards():
+    # patterns with other wildcards are still narrowed down by their prefix
+    all_fsas = fsa_codes.search(code="%")
+    for pattern, matches in [
+        ("T_S", lambda c: c[0] == "T" and c[2] == "S"),
+        ("_2S", lambda c: c[1:] == "2S"),
+        ("T%S", lambda c: c[0] == "T" and c[2] == "S"),
+        ("%S", lambda c: c[2] == "S"),
+    ]:
+        expected = [r for r in all_fsas if matches(r.code)] or None
+        assert fsa_codes.search(code=pattern) == expected
+
+    res = postal_codes.search(code="M5V 3_9")
+    assert res == [r for r in postal_codes.search(code="M5V 3%") if r.code[6] == "9"]
+    assert postal_codes.search(code="M5V3_%") is None
+    assert postal_codes.search(code="Z_V%") is None
+
+
+def test_search_iter():
+    res = postal_codes.search_iter(code="M%")
+    assert not isinstance(res, list)
+    first = list(itertools.islice(res, 10))
+    res.close()
+    assert [r.code for r in first] == sorted(r.code for r in first)
+    assert first == list(postal_codes.search_iter(code="M%", limit=10))
+    assert first[5:] == list(postal_codes.search_iter(code="M%", limit=5, offset=5))
+    assert postal_codes.search(code="M%", limit=10) == first
+
+    res = fsa_codes.search(province="Alberta")
+    assert list(fsa_codes.search_iter(province="Alberta", offset=3)) == res[3:]
+    assert list(fsa_codes.search_iter(province="California")) == []
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_fork():
+    parent_conn = fsa_codes.conn_manager._connect()
+    assert fsa_codes["T2S"].code == "T2S"
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # don't let an exception escape into the test runner's copy in the child
+        try:
+            conn = fsa_codes.conn_manager._connect()
+            ok = conn is not parent_conn and fsa_codes["T2S"].code == "T2S"
+            os.write(write_fd, b"1" if ok else b"0")
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == b"1"
+    os.close(read_fd)
+    assert fsa_codes.conn_manager._connect() is parent_conn